@@ -0,0 +1,453 @@
+"""
+Chart rendering shared by the api/chart-image function and the local chart
+server (scripts/chart-server.py).
+
+Each entry point supplies its own data fetching (display padding, the
+Supabase tier), trade overlay (price lines, markers, title) and response
+headers; everything else from query parsing to the PNG response lives
+here.
+"""
+
+from http.server import BaseHTTPRequestHandler
+import hashlib
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import matplotlib
+matplotlib.use('Agg')
+
+import mplfinance as mpf
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+import numpy as np
+import orjson
+import pandas as pd
+import pyspng
+from cachetools import TTLCache
+
+
+def create_custom_style():
+    """Create mplfinance style matching the app's dark theme."""
+    mc = mpf.make_marketcolors(
+        up='#10b981',
+        down='#ef4444',
+        edge={'up': '#10b981', 'down': '#ef4444'},
+        wick={'up': '#10b981', 'down': '#ef4444'},
+        volume={'up': '#10b98150', 'down': '#ef444450'},
+    )
+    return mpf.make_mpf_style(
+        base_mpl_style='dark_background',
+        marketcolors=mc,
+        facecolor='#18181b',
+        edgecolor='#27272a',
+        figcolor='#18181b',
+        gridcolor='#27272a',
+        gridstyle='-',
+        y_on_right=True,
+        rc={
+            'axes.labelcolor': '#a1a1aa',
+            'axes.edgecolor': '#27272a',
+            'xtick.color': '#a1a1aa',
+            'ytick.color': '#a1a1aa',
+            'font.size': 9,
+            'grid.linewidth': 0.5,
+        },
+    )
+
+
+def style_rc(style) -> dict:
+    """rcParams an mplfinance style sets when mpf.plot owns the figure.
+
+    mpf.plot leaves rcParams alone when drawing on our axes, so the same
+    settings are built here from the style's public fields: the base
+    matplotlib style, its rc overrides, then the colours and grid.
+    """
+    rc = dict(matplotlib.style.library[style['base_mpl_style']])
+    rc.update(style['rc'] or {})
+    rc.update({
+        'axes.facecolor': style['facecolor'],
+        'axes.edgecolor': style['edgecolor'],
+        'figure.facecolor': style['figcolor'],
+        'savefig.facecolor': style['figcolor'],
+        'grid.color': style['gridcolor'],
+        'grid.linestyle': style['gridstyle'],
+        'axes.grid.axis': 'both',
+        'axes.grid': True,
+    })
+    return rc
+
+
+# The style never depends on request params, so build it once per process
+STYLE = create_custom_style()
+# Figures are built without pyplot, so set the style's rcParams once here
+# rather than per figure, where it would race with renders on other threads
+matplotlib.rcParams.update(style_rc(STYLE))
+
+VOLUME_BAR_WIDTH = 0.8
+
+# In-process OHLCV cache keyed by (ticker, interval, window).
+# Intraday bars keep arriving during the session, so they expire sooner.
+_OHLCV_DAILY = TTLCache(maxsize=512, ttl=300)
+_OHLCV_INTRADAY = TTLCache(maxsize=512, ttl=60)
+_OHLCV_LOCK = threading.Lock()  # TTLCache is not thread-safe
+
+# Rendered (etag, png) pairs keyed by ChartRequest.cache_key(), so repeat
+# views skip fetching and matplotlib entirely. TTLs follow the OHLCV cache.
+_CHARTS_DAILY = TTLCache(maxsize=256, ttl=300)
+_CHARTS_INTRADAY = TTLCache(maxsize=256, ttl=60)
+_CHARTS_LOCK = threading.Lock()
+
+# Figures are reused across requests instead of being rebuilt by mpf.plot
+# each time. Each render checks one out of the pool, so concurrent requests
+# draw on separate figures. Past FIGURE_POOL_SIZE idle figures, returned
+# ones are dropped so a burst of requests doesn't pin its peak memory.
+FIGURE_POOL_SIZE = 4
+_FIGURE_POOL = queue.LifoQueue(maxsize=FIGURE_POOL_SIZE)
+
+
+def cached_ohlcv(
+    ticker: str,
+    interval: str,
+    window: tuple,
+    download: Callable[[], pd.DataFrame],
+) -> pd.DataFrame:
+    """Return OHLCV for the window from the in-process cache, or download() it.
+
+    `window` is any hashable identifying the date range, e.g. its start and
+    end days.
+    """
+    cache = _OHLCV_DAILY if interval == '1d' else _OHLCV_INTRADAY
+    key = (ticker, interval, window)
+    with _OHLCV_LOCK:
+        data = cache.get(key)
+    if data is not None:
+        print(f"[Memory] Using in-process data for {ticker} {interval}")
+        return data
+
+    # float32 is far finer than a 1200px chart can show and halves the
+    # memory mplfinance walks when building candles
+    data = download().astype(np.float32)
+
+    # yfinance returns an empty frame rather than raising when a download
+    # fails or is rate-limited, so leave those for the next request to retry
+    if not data.empty:
+        with _OHLCV_LOCK:
+            cache[key] = data
+    return data
+
+
+def _new_chart_figure():
+    """Build a price/volume figure on its own Agg canvas, outside pyplot."""
+    fig = Figure(figsize=(12, 4), dpi=100)
+    FigureCanvasAgg(fig)
+    ax_price, ax_volume = fig.subplots(
+        2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]}
+    )
+    return fig, ax_price, ax_volume
+
+
+@contextmanager
+def _chart_figure(width: int, height: int):
+    """Check a figure out of the pool for one render and clear it afterwards."""
+    try:
+        chart = _FIGURE_POOL.get_nowait()
+    except queue.Empty:
+        chart = _new_chart_figure()
+    fig, ax_price, ax_volume = chart
+    fig.set_size_inches(width / 100, height / 100)
+    # tight_layout adjusts from the figure's current margins, so start
+    # every render from the defaults for the same output on any figure
+    fig.subplots_adjust(**{
+        name: matplotlib.rcParams[f'figure.subplot.{name}']
+        for name in ('left', 'right', 'bottom', 'top', 'hspace')
+    })
+    try:
+        yield chart
+    finally:
+        ax_price.clear()
+        ax_volume.clear()
+        try:
+            _FIGURE_POOL.put_nowait(chart)
+        except queue.Full:
+            pass  # Pool is at capacity; let this figure be collected
+
+
+def encode_png(fig) -> bytes:
+    """Draw the figure with Agg and PNG-encode its RGBA buffer directly."""
+    fig.canvas.draw()
+    rgba = np.asarray(fig.canvas.buffer_rgba())
+    return pyspng.encode(rgba, compress_level=1)
+
+
+def to_soa(data: pd.DataFrame) -> dict:
+    """Split OHLCV data into plain NumPy arrays for the per-chart maths.
+
+    Indexing and reducing raw arrays skips pandas' dispatch overhead on
+    every call; the DataFrame itself is only kept for mpf.plot.
+    """
+    return {
+        'open': data['Open'].to_numpy(np.float32),
+        'high': data['High'].to_numpy(np.float32),
+        'low': data['Low'].to_numpy(np.float32),
+        'close': data['Close'].to_numpy(np.float32),
+        'volume': data['Volume'].to_numpy(np.float32),
+        'ts': data.index.as_unit('ns').asi8,
+    }
+
+
+def nearest_bars(index_ns: np.ndarray, leg_ns: np.ndarray) -> np.ndarray:
+    """Position of the nearest bar for each leg, by binary search on int64 ns."""
+    right = np.searchsorted(index_ns, leg_ns).clip(1, len(index_ns) - 1)
+    left = right - 1
+    idxs = np.where(leg_ns - index_ns[left] <= index_ns[right] - leg_ns, left, right)
+    return idxs.clip(0, len(index_ns) - 1)
+
+
+def draw_volume(ax_volume, bars: dict) -> None:
+    """Draw volume bars as one PolyCollection.
+
+    mplfinance draws volume with ax.bar, one Rectangle per candle, and
+    creating and drawing thousands of patches dominates render time for
+    intraday charts. A single collection gives the same pixels.
+    """
+    volume = bars['volume']
+    is_up = bars['open'] < bars['close']
+    x = np.arange(len(volume))
+    left = x - VOLUME_BAR_WIDTH / 2
+    right = x + VOLUME_BAR_WIDTH / 2
+    base = np.zeros(len(volume))
+    verts = np.stack([
+        np.column_stack([left, base]),
+        np.column_stack([left, volume]),
+        np.column_stack([right, volume]),
+        np.column_stack([right, base]),
+    ], axis=1)
+
+    colors = STYLE['marketcolors']
+    ax_volume.add_collection(
+        PolyCollection(
+            verts,
+            facecolors=np.where(is_up, colors['volume']['up'], colors['volume']['down']),
+            edgecolors=np.where(is_up, colors['vcedge']['up'], colors['vcedge']['down']),
+            linewidths=0.65,
+            # mplfinance's bars use alpha=1.0, overriding the colours' own alpha
+            alpha=1.0,
+        ),
+        autolim=False,
+    )
+    v_max = 1.1 * np.nanmax(volume)
+    ax_volume.set_ylim(0.3 * np.nanmin(volume), v_max)
+    ax_volume.set_axisbelow(True)
+    ax_volume.yaxis.tick_right()
+    ax_volume.yaxis.set_label_position('right')
+    ax_volume.tick_params(axis='x', rotation=45)
+
+    # Label volume in millions, as mplfinance does. The exponent is plain
+    # text: mathtext's parser is shared and not thread-safe, and labels are
+    # measured by concurrent renders in tight_layout
+    if v_max >= 1e6:
+        ax_volume.ticklabel_format(useOffset=False, scilimits=(6, 6), axis='y')
+        ax_volume.yaxis.offsetText.set_visible(False)
+        ax_volume.set_ylabel('Volume  10⁶')
+    else:
+        ax_volume.set_ylabel('Volume')
+
+
+def generate_chart(
+    data: pd.DataFrame,
+    draw_trade: Callable[[object, dict], None],
+    width: int = 1200,
+    height: int = 400,
+) -> bytes:
+    """Generate a candlestick chart; draw_trade(ax_price, bars) adds the trade."""
+
+    if data.empty:
+        raise ValueError("No data available")
+
+    bars = to_soa(data)
+
+    with _chart_figure(width, height) as (fig, ax_price, ax_volume):
+        mpf.plot(
+            data,
+            ax=ax_price,
+            type='candle',
+            style=STYLE,
+            tight_layout=True,
+            warn_too_much_data=10000,
+        )
+        draw_volume(ax_volume, bars)
+        draw_trade(ax_price, bars)
+
+        # Size the margins to the labels this chart draws (they vary with
+        # price magnitude and interval). tight_layout only lays out text;
+        # bbox_inches='tight' would cost a second full draw
+        fig.tight_layout(pad=0.6, h_pad=0.5)
+        return encode_png(fig)
+
+
+def chart_is_final(end_date: Optional[str], after: timedelta) -> bool:
+    """True once the padded window after a trade's exit is entirely in the past."""
+    if not end_date:
+        return False
+    try:
+        end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+    except ValueError:
+        return False
+    return end + after < datetime.now(end.tzinfo)
+
+
+def chart_etag(path: str, data: pd.DataFrame) -> str:
+    """Fingerprint a chart by its request and the latest candle it draws."""
+    digest = hashlib.md5(path.encode())
+    if not data.empty:
+        digest.update(str(data.index[-1]).encode())
+        digest.update(data.iloc[-1].to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against our (strong) ETag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+
+
+@dataclass(slots=True)
+class ChartRequest:
+    """Query parameters for one chart image."""
+
+    ticker: str
+    interval: str
+    from_date: Optional[str]
+    to_date: Optional[str]
+    entry_price: float
+    exit_price: Optional[float]
+    direction: str
+    legs: list
+
+    def cache_key(self) -> tuple:
+        """Hashable key covering every parameter that affects the image."""
+        return (
+            self.ticker,
+            self.interval,
+            self.from_date,
+            self.to_date,
+            self.entry_price,
+            self.exit_price,
+            self.direction,
+            orjson.dumps(self.legs, option=orjson.OPT_SORT_KEYS),
+        )
+
+
+def parse_chart_request(path: str) -> ChartRequest:
+    """Parse the chart query string into a ChartRequest."""
+    params = {key: values[0] for key, values in parse_qs(urlparse(path).query).items()}
+    exit_price = params.get('exit')
+    return ChartRequest(
+        ticker=params.get('ticker', 'AAPL'),
+        interval=params.get('interval', '1d'),
+        from_date=params.get('from'),
+        to_date=params.get('to'),
+        entry_price=float(params.get('entry', 0)),
+        exit_price=float(exit_price) if exit_price else None,
+        direction=params.get('direction', 'LONG'),
+        legs=orjson.loads(params.get('legs', '[]')),
+    )
+
+
+class ChartRequestHandler(BaseHTTPRequestHandler):
+    """Serves chart images; subclasses provide data fetching and headers.
+
+    Subclasses set display_padding ({interval: (before, after)}),
+    fetch_data(ticker, from_date, to_date, interval) and
+    draw_trade(ax_price, bars, req), which draws the trade's price lines,
+    markers and title over the candles. They may add extra_headers sent
+    with every chart response (e.g. CORS).
+    """
+
+    display_padding: Dict[str, Tuple[timedelta, timedelta]] = {}
+    extra_headers: Tuple[Tuple[str, str], ...] = ()
+
+    def fetch_data(self, ticker: str, from_date: Optional[str], to_date: Optional[str], interval: str) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def draw_trade(self, ax_price, bars: dict, req: ChartRequest) -> None:
+        raise NotImplementedError
+
+    def handle_chart_request(self):
+        try:
+            req = parse_chart_request(self.path)
+
+            # Reuse the rendered chart for repeat views of the same trade
+            key = req.cache_key()
+            charts = _CHARTS_DAILY if req.interval == '1d' else _CHARTS_INTRADAY
+            with _CHARTS_LOCK:
+                cached = charts.get(key)
+            if cached is not None:
+                print(f"[Memory] Using rendered chart for {req.ticker} {req.interval}")
+                etag, image_bytes = cached
+            else:
+                data = self.fetch_data(req.ticker, req.from_date, req.to_date, req.interval)
+                etag = chart_etag(self.path, data)
+
+            # Closed trades whose chart window has passed never change
+            _, after = self.display_padding.get(req.interval, self.display_padding['5m'])
+            if req.exit_price is not None and chart_is_final(req.to_date, after):
+                cache_control = 'public, max-age=31536000, immutable'
+            else:
+                cache_control = 'public, max-age=300'
+
+            # Revalidation: skip rendering if the client already has this chart
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                for name, value in self.extra_headers:
+                    self.send_header(name, value)
+                self.send_header('ETag', f'"{etag}"')
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                return
+
+            if cached is None:
+                image_bytes = generate_chart(
+                    data, lambda ax_price, bars: self.draw_trade(ax_price, bars, req)
+                )
+                with _CHARTS_LOCK:
+                    charts[key] = (etag, image_bytes)
+
+            self.send_png(image_bytes, etag, cache_control)
+
+        except Exception as e:
+            print(f"Error: {e}")
+            self.send_response(500)
+            self.send_header('Content-Type', 'application/json')
+            for name, value in self.extra_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(orjson.dumps({'error': str(e)}))
+
+    def send_png(self, image_bytes: bytes, etag: str, cache_control: str) -> None:
+        """Send a 200 PNG response as a single write.
+
+        send_header/end_headers flush the headers in one write and the body
+        goes out in another; joining them saves a syscall per response.
+        """
+        self.log_request(200)
+        head = (
+            f'{self.protocol_version} 200 OK\r\n'
+            f'Server: {self.version_string()}\r\n'
+            f'Date: {self.date_time_string()}\r\n'
+            'Content-Type: image/png\r\n'
+            f'Content-Length: {len(image_bytes)}\r\n'
+            + ''.join(f'{name}: {value}\r\n' for name, value in self.extra_headers)
+            + f'Cache-Control: {cache_control}\r\n'
+            f'ETag: "{etag}"\r\n'
+            '\r\n'
+        )
+        self.wfile.write(head.encode('latin-1') + image_bytes)
@@ -1,76 +1,18 @@
-from http.server import BaseHTTPRequestHandler
-import json
-import io
-import base64
-from urllib.parse import urlparse, parse_qs
 from datetime import datetime, timedelta
 
 import yfinance as yf
-import mplfinance as mpf
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import pandas as pd
 import numpy as np
+import pandas as pd
 
-
-# Custom style matching the app's dark theme
-CHART_STYLE = {
-    'base_mpl_style': 'dark_background',
-    'marketcolors': {
-        'candle': {'up': '#10b981', 'down': '#ef4444'},
-        'edge': {'up': '#10b981', 'down': '#ef4444'},
-        'wick': {'up': '#10b981', 'down': '#ef4444'},
-        'ohlc': {'up': '#10b981', 'down': '#ef4444'},
-        'volume': {'up': '#10b98150', 'down': '#ef444450'},
-        'vcedge': {'up': '#10b981', 'down': '#ef4444'},
-        'vcdopcod': False,
-        'alpha': 1.0,
-    },
-    'mavcolors': ['#3b82f6', '#f59e0b', '#8b5cf6'],
-    'facecolor': '#18181b',
-    'edgecolor': '#27272a',
-    'figcolor': '#18181b',
-    'gridcolor': '#27272a',
-    'gridstyle': '-',
-    'gridwidth': 0.5,
-    'y_on_right': True,
-    'rc': {
-        'axes.labelcolor': '#a1a1aa',
-        'axes.edgecolor': '#27272a',
-        'xtick.color': '#a1a1aa',
-        'ytick.color': '#a1a1aa',
-        'font.size': 9,
-    },
-}
+from api._lib.charts import ChartRequest, ChartRequestHandler, cached_ohlcv, nearest_bars
 
 
-def create_custom_style():
-    """Create mplfinance style from our config."""
-    mc = mpf.make_marketcolors(
-        up='#10b981',
-        down='#ef4444',
-        edge={'up': '#10b981', 'down': '#ef4444'},
-        wick={'up': '#10b981', 'down': '#ef4444'},
-        volume={'up': '#10b98150', 'down': '#ef444450'},
-    )
-    return mpf.make_mpf_style(
-        base_mpl_style='dark_background',
-        marketcolors=mc,
-        facecolor='#18181b',
-        edgecolor='#27272a',
-        figcolor='#18181b',
-        gridcolor='#27272a',
-        gridstyle='-',
-        gridwidth=0.5,
-        y_on_right=True,
-        rc={
-            'axes.labelcolor': '#a1a1aa',
-            'axes.edgecolor': '#27272a',
-            'xtick.color': '#a1a1aa',
-            'ytick.color': '#a1a1aa',
-            'font.size': 9,
-        },
-    )
+# Chart context shown (before entry, after exit)
+DISPLAY_PADDING = {
+    '1d': (timedelta(days=30), timedelta(days=5)),
+    '1h': (timedelta(days=5), timedelta(days=1)),
+    '5m': (timedelta(days=1), timedelta(days=1)),
+}
 
 
 def fetch_data(ticker: str, start_date: str, end_date: str, interval: str = '1d') -> pd.DataFrame:
@@ -80,165 +22,102 @@ def fetch_data(ticker: str, start_date: str, end_date: str, interval: str = '1d'
     end = datetime.fromisoformat(end_date.replace('Z', '+00:00')) if end_date else datetime.now()
 
     # Padding based on interval
-    if interval == '1d':
-        start = start - timedelta(days=30)
-        end = end + timedelta(days=5)
-    elif interval == '1h':
-        start = start - timedelta(days=5)
-        end = end + timedelta(days=1)
-    else:  # 5m
-        start = start - timedelta(days=1)
-        end = end + timedelta(days=1)
+    before, after = DISPLAY_PADDING.get(interval, DISPLAY_PADDING['5m'])
+    start = start - before
+    end = end + after
 
     # Yahoo Finance interval mapping
     yf_interval = {'1d': '1d', '1h': '1h', '5m': '5m'}.get(interval, '1d')
 
-    data = yf.download(
-        ticker,
-        start=start.strftime('%Y-%m-%d'),
-        end=end.strftime('%Y-%m-%d'),
-        interval=yf_interval,
-        progress=False,
-    )
+    def download() -> pd.DataFrame:
+        data = yf.download(
+            ticker,
+            start=start.strftime('%Y-%m-%d'),
+            end=end.strftime('%Y-%m-%d'),
+            interval=yf_interval,
+            progress=False,
+        )
 
-    return data
-
-
-def generate_chart(
-    ticker: str,
-    data: pd.DataFrame,
-    legs: list,
-    entry_price: float,
-    exit_price: float | None,
-    direction: str,
-    width: int = 1200,
-    height: int = 400,
-) -> bytes:
-    """Generate candlestick chart with trade markers."""
-
-    if data.empty:
-        raise ValueError("No data available")
-
-    style = create_custom_style()
-
-    # Create figure
-    fig, axes = mpf.plot(
-        data,
-        type='candle',
-        style=style,
-        volume=True,
-        returnfig=True,
-        figsize=(width / 100, height / 100),
-        tight_layout=True,
-        warn_too_much_data=10000,
-    )
+        # Flatten MultiIndex columns (yfinance returns ('Open', 'AAPL') format)
+        if isinstance(data.columns, pd.MultiIndex):
+            data.columns = data.columns.get_level_values(0)
+        return data
 
-    ax_price = axes[0]
-    ax_volume = axes[2] if len(axes) > 2 else None
+    return cached_ohlcv(ticker, yf_interval, (start.date(), end.date()), download)
 
+
+def draw_trade(ax_price, bars: dict, req: ChartRequest) -> None:
+    """Draw the entry/exit lines, leg markers at their fill prices and the title."""
     # Add entry/exit price lines
     ax_price.axhline(
-        y=entry_price,
+        y=req.entry_price,
         color='#10b981',
         linestyle='--',
         linewidth=1,
         alpha=0.8,
-        label=f'Entry ${entry_price:.2f}',
+        label=f'Entry ${req.entry_price:.2f}',
     )
 
-    if exit_price:
-        is_profit = (exit_price > entry_price) if direction == 'LONG' else (exit_price < entry_price)
+    if req.exit_price:
+        is_profit = (req.exit_price > req.entry_price) if req.direction == 'LONG' else (req.exit_price < req.entry_price)
         ax_price.axhline(
-            y=exit_price,
+            y=req.exit_price,
             color='#10b981' if is_profit else '#ef4444',
             linestyle='--',
             linewidth=1,
             alpha=0.8,
-            label=f'Exit ${exit_price:.2f}',
+            label=f'Exit ${req.exit_price:.2f}',
         )
 
-    # Add trade markers
-    for leg in legs:
-        try:
-            leg_date = pd.Timestamp(leg['executed_at']).tz_localize(None)
-            # Find nearest date in data
-            idx = data.index.get_indexer([leg_date], method='nearest')[0]
-            if 0 <= idx < len(data):
-                x_pos = idx
-                y_pos = leg['price']
-
-                is_buy = leg['leg_type'] in ['ENTRY', 'ADD']
-                marker = '^' if is_buy else 'v'
-                color = '#10b981' if leg['leg_type'] == 'ENTRY' else '#3b82f6' if leg['leg_type'] == 'ADD' else '#f59e0b' if leg['leg_type'] == 'TRIM' else '#ef4444'
-
-                ax_price.scatter(
-                    x_pos,
-                    y_pos,
-                    marker=marker,
-                    color=color,
-                    s=100,
-                    zorder=5,
-                    edgecolors='white',
-                    linewidths=0.5,
-                )
-        except Exception:
-            continue
+    # Add trade markers, resolving every leg to its nearest candle in one
+    # pass. Leg times are parsed as UTC, which is what the ns timestamps
+    # hold for tz-aware (intraday) indexes; naive daily indexes compare as
+    # UTC too. Legs with an unparseable time or price are skipped.
+    legs = req.legs
+    leg_types = np.array([leg.get('leg_type') for leg in legs], dtype=object)
+    leg_dates = pd.to_datetime(
+        [leg.get('executed_at', '') for leg in legs],
+        utc=True,
+        errors='coerce',
+        format='ISO8601',
+    )
+    leg_prices = pd.to_numeric(
+        pd.Series([leg.get('price') for leg in legs], dtype=object),
+        errors='coerce',
+    ).to_numpy(np.float64)
+    valid = ~leg_dates.isna() & ~np.isnan(leg_prices)
+
+    idxs = nearest_bars(bars['ts'], leg_dates[valid].as_unit('ns').asi8)
+    leg_types = leg_types[valid]
+    is_buy = np.isin(leg_types, ['ENTRY', 'ADD'])
+    colors = {'ENTRY': '#10b981', 'ADD': '#3b82f6', 'TRIM': '#f59e0b'}
+    marker_colors = np.array([colors.get(t, '#ef4444') for t in leg_types], dtype=object)
+
+    for mask, marker in ((is_buy, '^'), (~is_buy, 'v')):
+        if mask.any():
+            ax_price.scatter(
+                idxs[mask],
+                leg_prices[valid][mask],
+                marker=marker,
+                c=marker_colors[mask],
+                s=100,
+                zorder=5,
+                edgecolors='white',
+                linewidths=0.5,
+            )
 
     # Add title
-    ax_price.set_title(f'{ticker} - Daily', color='#a1a1aa', fontsize=11, loc='left', pad=10)
+    ax_price.set_title(f'{req.ticker} - Daily', color='#a1a1aa', fontsize=11, loc='left', pad=10)
 
-    # Save to bytes
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png', dpi=150, bbox_inches='tight', facecolor='#18181b', edgecolor='none')
-    buf.seek(0)
-    plt.close(fig)
 
-    return buf.getvalue()
+class handler(ChartRequestHandler):
+    display_padding = DISPLAY_PADDING
 
+    def fetch_data(self, ticker, from_date, to_date, interval):
+        return fetch_data(ticker, from_date, to_date, interval)
 
-class handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        try:
-            # Parse URL
-            parsed = urlparse(self.path)
-            params = parse_qs(parsed.query)
-
-            # Extract parameters
-            ticker = params.get('ticker', ['AAPL'])[0]
-            interval = params.get('interval', ['1d'])[0]
-            from_date = params.get('from', [None])[0]
-            to_date = params.get('to', [None])[0]
-            entry_price = float(params.get('entry', [0])[0])
-            exit_price = params.get('exit', [None])[0]
-            exit_price = float(exit_price) if exit_price else None
-            direction = params.get('direction', ['LONG'])[0]
-
-            # Parse legs from JSON
-            legs_json = params.get('legs', ['[]'])[0]
-            legs = json.loads(legs_json)
-
-            # Fetch data
-            data = fetch_data(ticker, from_date, to_date, interval)
-
-            # Generate chart
-            image_bytes = generate_chart(
-                ticker=ticker,
-                data=data,
-                legs=legs,
-                entry_price=entry_price,
-                exit_price=exit_price,
-                direction=direction,
-            )
+    def draw_trade(self, ax_price, bars, req):
+        draw_trade(ax_price, bars, req)
 
-            # Return image
-            self.send_response(200)
-            self.send_header('Content-Type', 'image/png')
-            self.send_header('Cache-Control', 'public, max-age=300')
-            self.end_headers()
-            self.wfile.write(image_bytes)
-
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': str(e)}).encode())
+    def do_GET(self):
+        self.handle_chart_request()
@@ -5,21 +5,29 @@ Run this alongside Next.js dev server for local chart testing.
 
 Usage: python3 scripts/chart-server.py
 Server runs on http://localhost:3002
+
+It can also run as a long-lived chart worker in production, which avoids
+the serverless function's per-request interpreter start and imports.
+Set CHART_SERVER_HOST=0.0.0.0 and PORT as required by the host, and point
+NEXT_PUBLIC_CHART_SERVER_URL at it.
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import json
-import io
+from http.server import ThreadingHTTPServer
 import os
-from urllib.parse import urlparse, parse_qs
-from datetime import datetime, timedelta
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
 from typing import Optional, List
 
 import yfinance as yf
-import mplfinance as mpf
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
+# Rendering is shared with the api/chart-image function
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from api._lib.charts import ChartRequest, ChartRequestHandler, cached_ohlcv, nearest_bars
+
 # Try to import supabase for cache support
 try:
     from supabase import create_client
@@ -42,6 +50,23 @@ CACHE_PADDING = {
     '1h': {'before': 2 * 24 * 60 * 60, 'after': 2 * 24 * 60 * 60},  # 2 days each
 }
 
+# Display padding (before entry, after exit) - this is for chart aesthetics
+DISPLAY_PADDING = {
+    '1d': (timedelta(days=30), timedelta(days=10)),
+    '1h': (timedelta(days=5), timedelta(days=3)),
+    '5m': (timedelta(hours=4), timedelta(hours=2)),  # 4 hours before to show setup context
+}
+
+
+# chart_cache candle keys -> OHLCV column names
+CANDLE_COLUMNS = {
+    'open': 'Open',
+    'high': 'High',
+    'low': 'Low',
+    'close': 'Close',
+    'volume': 'Volume',
+}
+
 
 def fetch_from_cache(ticker: str, interval: str, entry_date: datetime, exit_date: datetime) -> Optional[pd.DataFrame]:
     """Try to fetch chart data from Supabase cache."""
@@ -67,56 +92,190 @@ def fetch_from_cache(ticker: str, interval: str, entry_date: datetime, exit_date
             candles = result.data['candles']
             print(f"[Cache] Using cached data for {ticker} {interval}: {len(candles)} candles")
 
-            # Convert to DataFrame
-            df = pd.DataFrame(candles)
-            df['time'] = pd.to_datetime(df['time'])
-            df.set_index('time', inplace=True)
-            df.rename(columns={
-                'open': 'Open',
-                'high': 'High',
-                'low': 'Low',
-                'close': 'Close',
-                'volume': 'Volume'
-            }, inplace=True)
-
-            return df
+            # Build float32 columns directly from the candle dicts, parsing
+            # the ISO timestamps with an explicit format
+            index = pd.to_datetime(
+                [candle['time'] for candle in candles],
+                utc=True,
+                format='ISO8601',
+            ).rename('time')
+            return pd.DataFrame(
+                {
+                    column: np.fromiter(
+                        (candle[key] for candle in candles),
+                        dtype=np.float32,
+                        count=len(candles),
+                    )
+                    for key, column in CANDLE_COLUMNS.items()
+                },
+                index=index,
+            )
     except Exception as e:
         print(f"[Cache] Cache miss or error: {e}")
 
     return None
 
 
-def create_custom_style():
-    """Create mplfinance style matching the app's dark theme."""
-    mc = mpf.make_marketcolors(
-        up='#10b981',
-        down='#ef4444',
-        edge={'up': '#10b981', 'down': '#ef4444'},
-        wick={'up': '#10b981', 'down': '#ef4444'},
-        volume={'up': '#10b98150', 'down': '#ef444450'},
-    )
-    return mpf.make_mpf_style(
-        base_mpl_style='dark_background',
-        marketcolors=mc,
-        facecolor='#18181b',
-        edgecolor='#27272a',
-        figcolor='#18181b',
-        gridcolor='#27272a',
-        gridstyle='-',
-        y_on_right=True,
-        rc={
-            'axes.labelcolor': '#a1a1aa',
-            'axes.edgecolor': '#27272a',
-            'xtick.color': '#a1a1aa',
-            'ytick.color': '#a1a1aa',
-            'font.size': 9,
-            'grid.linewidth': 0.5,
-        },
-    )
+# Concurrent chart requests for one interval share a single yf.download.
+# The first caller waits up to BATCH_MAX_WAIT_MS for others to join, then
+# downloads every queued ticker over the union of their date ranges.
+BATCH_MAX_WAIT_MS = 25
+BATCH_MAX_TICKERS = 20  # Yahoo's per-request symbol limit
+BATCH_TIMEOUT_S = 60  # Backstop for callers waiting on another thread's download
+
+# Yahoo only serves intraday bars this far back, and rejects the whole
+# download if its range starts earlier
+INTRADAY_LOOKBACK = {'5m': timedelta(days=60), '1h': timedelta(days=730)}
+
+
+class _BatchRequest:
+    __slots__ = ('ticker', 'start', 'end', 'queued', 'done', 'data', 'error')
+
+    def __init__(self, ticker: str, start: date, end: date):
+        self.ticker = ticker
+        self.start = start
+        self.end = end
+        self.queued = True
+        self.done = False
+        self.data: Optional[pd.DataFrame] = None
+        self.error: Optional[Exception] = None
+
+
+class _DownloadBatcher:
+    """Coalesces overlapping yf.download calls for one interval."""
+
+    def __init__(self, interval: str):
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._queue: List[_BatchRequest] = []
+        self._collecting = False
+
+    def download(self, ticker: str, start: date, end: date) -> pd.DataFrame:
+        """Fetch [start, end) for one ticker, batched with concurrent callers."""
+        request = _BatchRequest(ticker, start, end)
+        give_up = time.monotonic() + BATCH_TIMEOUT_S
+        with self._cond:
+            self._queue.append(request)
+            while not request.done:
+                if self._collecting or not request.queued:
+                    # Another caller is gathering or downloading our batch
+                    remaining = give_up - time.monotonic()
+                    if remaining <= 0:
+                        if request.queued:
+                            self._queue.remove(request)
+                        raise TimeoutError(f"Timed out waiting for batched download of {ticker}")
+                    self._cond.wait(remaining)
+                    continue
+
+                # Lead the next batch: give concurrent requests a moment to join
+                self._collecting = True
+                deadline = time.monotonic() + BATCH_MAX_WAIT_MS / 1000
+                while len(self._queue) < BATCH_MAX_TICKERS:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+                self._collecting = False
+                self._cond.notify_all()
+
+                self._cond.release()
+                try:
+                    self._run(batch)
+                finally:
+                    self._cond.acquire()
+                    self._cond.notify_all()
+
+        if request.error is not None:
+            raise request.error
+        return request.data
+
+    def _take_batch(self) -> List[_BatchRequest]:
+        """Dequeue requests covering at most BATCH_MAX_TICKERS symbols.
+
+        A request starting before Yahoo's intraday window is downloaded on
+        its own: merged into a batch, its range would fail every ticker.
+        """
+        first = self._queue[0]
+        if not self._in_window(first):
+            first.queued = False
+            self._queue.pop(0)
+            return [first]
+
+        batch = []
+        tickers = set()
+        for request in self._queue:
+            if not self._in_window(request):
+                continue
+            if request.ticker not in tickers and len(tickers) >= BATCH_MAX_TICKERS:
+                continue
+            tickers.add(request.ticker)
+            request.queued = False
+            batch.append(request)
+        self._queue = [r for r in self._queue if r.queued]
+        return batch
+
+    def _in_window(self, request: _BatchRequest) -> bool:
+        """Whether Yahoo still serves this interval's bars from request.start."""
+        lookback = INTRADAY_LOOKBACK.get(self.interval)
+        return lookback is None or request.start > date.today() - lookback
+
+    def _run(self, batch: List[_BatchRequest]) -> None:
+        """Download the batch in one call and hand each caller its slice."""
+        tickers = sorted({r.ticker for r in batch})
+        start = min(r.start for r in batch)
+        end = max(r.end for r in batch)
+        if len(tickers) > 1:
+            print(f"[Batch] Downloading {len(tickers)} tickers ({self.interval}): {' '.join(tickers)}")
+
+        # Every caller in the batch must end up with data or an error and
+        # done=True, or it waits on the condition until it times out
+        try:
+            data = yf.download(
+                ' '.join(tickers),
+                start=start.strftime('%Y-%m-%d'),
+                end=end.strftime('%Y-%m-%d'),
+                interval=self.interval,
+                group_by='ticker',
+                progress=False,
+            )
+            for request in batch:
+                try:
+                    request.data = self._slice(data, request)
+                except Exception as e:
+                    request.error = e
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                if request.data is None and request.error is None:
+                    request.error = RuntimeError(f"Batched download failed for {request.ticker}")
+                request.done = True
+
+    @staticmethod
+    def _slice(data: pd.DataFrame, request: _BatchRequest) -> pd.DataFrame:
+        """Cut one caller's ticker and date range out of the batch download."""
+        # group_by='ticker' puts the symbol on the first column level
+        if isinstance(data.columns, pd.MultiIndex):
+            frame = data.get(request.ticker)
+        else:
+            frame = data
+        if frame is None or frame.empty:
+            return pd.DataFrame()
+        # .loc range slicing needs a sorted index
+        if not frame.index.is_monotonic_increasing:
+            frame = frame.sort_index()
+        # Yahoo treats `end` as exclusive; .loc date slicing is inclusive
+        last_day = request.end - timedelta(days=1)
+        return frame.loc[str(request.start):str(last_day)].dropna(how='all')
+
+
+_DOWNLOAD_BATCHERS = {interval: _DownloadBatcher(interval) for interval in ('1d', '1h', '5m')}
 
 
 def fetch_data(ticker: str, start_date: str, end_date: str, interval: str = '1d') -> pd.DataFrame:
-    """Fetch OHLCV data from Yahoo Finance, checking cache first for intraday data."""
+    """Fetch OHLCV data from Yahoo Finance, checking the caches first."""
     try:
         entry_date = datetime.fromisoformat(start_date.replace('Z', '+00:00').replace('+00:00', ''))
     except:
@@ -127,27 +286,10 @@ def fetch_data(ticker: str, start_date: str, end_date: str, interval: str = '1d'
     except:
         exit_date = datetime.now()
 
-    # For intraday intervals, check cache first
-    if interval in ('5m', '1h'):
-        cached_data = fetch_from_cache(ticker, interval, entry_date, exit_date)
-        if cached_data is not None and not cached_data.empty:
-            print(f"[Cache] Using cached data for {ticker} {interval}")
-            return cached_data
-        else:
-            print(f"[Cache] No cached data for {ticker} {interval}, falling back to Yahoo Finance")
-
     # Calculate display padding (different from cache padding - this is for chart aesthetics)
-    start = entry_date
-    end = exit_date
-    if interval == '1d':
-        start = start - timedelta(days=30)
-        end = end + timedelta(days=10)
-    elif interval == '1h':
-        start = start - timedelta(days=5)
-        end = end + timedelta(days=3)
-    else:  # 5m
-        start = start - timedelta(hours=4)  # 4 hours before to show setup context
-        end = end + timedelta(hours=2)
+    before, after = DISPLAY_PADDING.get(interval, DISPLAY_PADDING['5m'])
+    start = entry_date - before
+    end = exit_date + after
 
     # Handle date clamping - ensure we don't request future data
     now = datetime.now()
@@ -164,56 +306,34 @@ def fetch_data(ticker: str, start_date: str, end_date: str, interval: str = '1d'
 
     yf_interval = {'1d': '1d', '1h': '1h', '5m': '5m'}.get(interval, '1d')
 
-    data = yf.download(
-        ticker,
-        start=start.strftime('%Y-%m-%d'),
-        end=end.strftime('%Y-%m-%d'),
-        interval=yf_interval,
-        progress=False,
-    )
+    def download() -> pd.DataFrame:
+        # For intraday intervals, the Supabase cache backs the in-process one
+        if interval in ('5m', '1h'):
+            cached_data = fetch_from_cache(ticker, interval, entry_date, exit_date)
+            if cached_data is not None and not cached_data.empty:
+                print(f"[Cache] Using cached data for {ticker} {interval}")
+                return cached_data
+            else:
+                print(f"[Cache] No cached data for {ticker} {interval}, falling back to Yahoo Finance")
 
-    # Flatten MultiIndex columns (yfinance returns ('Open', 'AAPL') format)
-    if isinstance(data.columns, pd.MultiIndex):
-        data.columns = data.columns.get_level_values(0)
-
-    return data
-
-
-def generate_chart(
-    ticker: str,
-    data: pd.DataFrame,
-    legs: List,
-    entry_price: float,
-    exit_price: Optional[float],
-    direction: str,
-    interval: str = '1d',
-    width: int = 1200,
-    height: int = 400,
-) -> bytes:
-    """Generate candlestick chart with trade markers."""
-
-    if data.empty:
-        raise ValueError("No data available")
-
-    style = create_custom_style()
-
-    # Create figure
-    fig, axes = mpf.plot(
-        data,
-        type='candle',
-        style=style,
-        volume=True,
-        returnfig=True,
-        figsize=(width / 100, height / 100),
-        tight_layout=True,
-        warn_too_much_data=10000,
-    )
+        return _DOWNLOAD_BATCHERS[yf_interval].download(ticker, start.date(), end.date())
+
+    # Supabase rows cover a trade's exact times rather than whole days, so
+    # intraday windows are keyed the same way; open trades share one entry
+    if interval in ('5m', '1h'):
+        window = (entry_date, exit_date if end_date else None)
+    else:
+        window = (start.date(), end.date())
 
-    ax_price = axes[0]
+    # In-process cache first, then Supabase, then Yahoo Finance
+    return cached_ohlcv(ticker, yf_interval, window, download)
 
+
+def draw_trade(ax_price, bars: dict, req: ChartRequest) -> None:
+    """Draw the entry/exit lines, leg markers beside their candles and the title."""
     # Add entry price line
     ax_price.axhline(
-        y=entry_price,
+        y=req.entry_price,
         color='#10b981',
         linestyle='--',
         linewidth=1,
@@ -221,10 +341,10 @@ def generate_chart(
     )
 
     # Add exit price line
-    if exit_price:
-        is_profit = (exit_price > entry_price) if direction == 'LONG' else (exit_price < entry_price)
+    if req.exit_price:
+        is_profit = (req.exit_price > req.entry_price) if req.direction == 'LONG' else (req.exit_price < req.entry_price)
         ax_price.axhline(
-            y=exit_price,
+            y=req.exit_price,
             color='#10b981' if is_profit else '#ef4444',
             linestyle='--',
             linewidth=1,
@@ -233,79 +353,71 @@ def generate_chart(
 
     # Add trade markers
     # Calculate offset for marker placement (4% of price range for better visibility)
-    price_range = data['High'].max() - data['Low'].min()
+    data_low = np.nanmin(bars['low'])
+    data_high = np.nanmax(bars['high'])
+    price_range = data_high - data_low
     marker_offset = price_range * 0.04
 
-    # Track used positions to offset overlapping markers horizontally
-    used_positions = {}  # idx -> list of marker types at that position
+    # Resolve every leg to its nearest candle in one pass
+    leg_types = np.array([leg.get('leg_type') for leg in req.legs], dtype=object)
+    leg_dates = pd.to_datetime(
+        [leg.get('executed_at', '') for leg in req.legs],
+        utc=True,
+        errors='coerce',
+        format='ISO8601',
+    )
+    parsed = ~leg_dates.isna()
+    if not parsed.all():
+        print(f"Error adding marker: skipped {(~parsed).sum()} leg(s) with invalid executed_at")
+    leg_types = leg_types[parsed]
+
+    # Leg times are UTC, which is also what the ns timestamps hold for
+    # tz-aware indexes and how naive leg times are compared against
+    # naive indexes
+    idxs = nearest_bars(bars['ts'], leg_dates[parsed].as_unit('ns').asi8)
+
+    is_buy = np.isin(leg_types, ['ENTRY', 'ADD'])
+
+    # Offset overlapping markers horizontally: Entry/Add markers start
+    # slightly left, Exit/Trim markers slightly right, and each further
+    # marker on the same candle shifts right
+    order = np.argsort(idxs, kind='stable')
+    run_starts = np.flatnonzero(np.diff(idxs[order], prepend=-1))
+    run_lengths = np.diff(run_starts, append=len(idxs))
+    marker_counts = np.empty(len(idxs), dtype=np.int64)
+    marker_counts[order] = np.arange(len(idxs)) - np.repeat(run_starts, run_lengths)
+    x_pos = idxs + np.where(is_buy, -0.15, 0.15) + marker_counts * 0.15
+
+    # Place buy markers below candle low, sell markers above candle high
+    y_pos = np.where(
+        is_buy,
+        bars['low'][idxs] - marker_offset,
+        bars['high'][idxs] + marker_offset,
+    )
 
-    for leg in legs:
-        try:
-            leg_date_str = leg.get('executed_at', '')
-            leg_date = pd.Timestamp(leg_date_str)
-
-            # Handle timezone: make leg_date match data index timezone
-            if data.index.tz is not None:
-                # Data has timezone, localize leg_date if needed
-                if leg_date.tz is None:
-                    leg_date = leg_date.tz_localize('UTC').tz_convert(data.index.tz)
-                else:
-                    leg_date = leg_date.tz_convert(data.index.tz)
-            else:
-                # Data has no timezone, remove timezone from leg_date
-                if leg_date.tz is not None:
-                    leg_date = leg_date.tz_localize(None)
-
-            # Find nearest date in data
-            idx = data.index.get_indexer([leg_date], method='nearest')[0]
-            if 0 <= idx < len(data):
-                candle = data.iloc[idx]
-
-                is_buy = leg.get('leg_type') in ['ENTRY', 'ADD']
-                marker = '^' if is_buy else 'v'
-
-                # Calculate horizontal offset for overlapping markers
-                # Entry/Add markers go slightly left, Exit/Trim markers go slightly right
-                marker_count = used_positions.get(idx, 0)
-                if is_buy:
-                    x_offset = -0.15 + (marker_count * 0.15)  # Buys start left
-                else:
-                    x_offset = 0.15 + (marker_count * 0.15)   # Sells start right
-                used_positions[idx] = marker_count + 1
-                x_pos = idx + x_offset
-
-                # Place buy markers below candle low, sell markers above candle high
-                if is_buy:
-                    y_pos = candle['Low'] - marker_offset
-                else:
-                    y_pos = candle['High'] + marker_offset
-
-                colors = {
-                    'ENTRY': '#10b981',
-                    'ADD': '#3b82f6',
-                    'TRIM': '#f59e0b',
-                    'EXIT': '#ef4444',
-                }
-                color = colors.get(leg.get('leg_type'), '#71717a')
-
-                ax_price.scatter(
-                    x_pos,
-                    y_pos,
-                    marker=marker,
-                    color=color,
-                    s=150,
-                    zorder=5,
-                    edgecolors='white',
-                    linewidths=1,
-                )
-        except Exception as e:
-            print(f"Error adding marker: {e}")
-            continue
+    colors = {
+        'ENTRY': '#10b981',
+        'ADD': '#3b82f6',
+        'TRIM': '#f59e0b',
+        'EXIT': '#ef4444',
+    }
+    marker_colors = np.array([colors.get(t, '#71717a') for t in leg_types], dtype=object)
+
+    for mask, marker in ((is_buy, '^'), (~is_buy, 'v')):
+        if mask.any():
+            ax_price.scatter(
+                x_pos[mask],
+                y_pos[mask],
+                marker=marker,
+                c=marker_colors[mask],
+                s=150,
+                zorder=5,
+                edgecolors='white',
+                linewidths=1,
+            )
 
     # Expand y-axis to ensure markers are visible
     y_min, y_max = ax_price.get_ylim()
-    data_low = data['Low'].min()
-    data_high = data['High'].max()
     # Add 8% padding below for entry markers, 5% above for exit markers
     new_y_min = min(y_min, data_low - price_range * 0.08)
     new_y_max = max(y_max, data_high + price_range * 0.08)
@@ -314,23 +426,25 @@ def generate_chart(
     # Add title
     interval_labels = {'1d': 'Daily', '1h': 'Hourly', '5m': '5 Min'}
     ax_price.set_title(
-        f'{ticker} - {interval_labels.get(interval, interval)}',
+        f'{req.ticker} - {interval_labels.get(req.interval, req.interval)}',
         color='#a1a1aa',
         fontsize=11,
         loc='left',
         pad=10
     )
 
-    # Save to bytes
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png', dpi=150, bbox_inches='tight', facecolor='#18181b', edgecolor='none')
-    buf.seek(0)
-    plt.close(fig)
 
-    return buf.getvalue()
+class ChartHandler(ChartRequestHandler):
+    display_padding = DISPLAY_PADDING
+    extra_headers = (('Access-Control-Allow-Origin', '*'),)
+
+    def fetch_data(self, ticker, from_date, to_date, interval):
+        print(f"Generating chart for {ticker} ({interval})")
+        return fetch_data(ticker, from_date, to_date, interval)
 
+    def draw_trade(self, ax_price, bars, req):
+        draw_trade(ax_price, bars, req)
 
-class ChartHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         # Handle CORS preflight
         if self.path.startswith('/api/chart-image'):
@@ -338,51 +452,6 @@ class ChartHandler(BaseHTTPRequestHandler):
         else:
             self.send_error(404)
 
-    def handle_chart_request(self):
-        try:
-            parsed = urlparse(self.path)
-            params = parse_qs(parsed.query)
-
-            ticker = params.get('ticker', ['AAPL'])[0]
-            interval = params.get('interval', ['1d'])[0]
-            from_date = params.get('from', [None])[0]
-            to_date = params.get('to', [None])[0]
-            entry_price = float(params.get('entry', ['0'])[0])
-            exit_price = params.get('exit', [None])[0]
-            exit_price = float(exit_price) if exit_price else None
-            direction = params.get('direction', ['LONG'])[0]
-
-            legs_json = params.get('legs', ['[]'])[0]
-            legs = json.loads(legs_json)
-
-            print(f"Generating chart for {ticker} ({interval})")
-
-            data = fetch_data(ticker, from_date, to_date, interval)
-            image_bytes = generate_chart(
-                ticker=ticker,
-                data=data,
-                legs=legs,
-                entry_price=entry_price,
-                exit_price=exit_price,
-                direction=direction,
-                interval=interval,
-            )
-
-            self.send_response(200)
-            self.send_header('Content-Type', 'image/png')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Cache-Control', 'public, max-age=300')
-            self.end_headers()
-            self.wfile.write(image_bytes)
-
-        except Exception as e:
-            print(f"Error: {e}")
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': str(e)}).encode())
-
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -395,9 +464,10 @@ class ChartHandler(BaseHTTPRequestHandler):
 
 
 if __name__ == '__main__':
-    port = 3002
-    server = HTTPServer(('localhost', port), ChartHandler)
-    print(f"🎨 Chart server running at http://localhost:{port}")
+    host = os.environ.get('CHART_SERVER_HOST', 'localhost')
+    port = int(os.environ.get('PORT', 3002))
+    server = ThreadingHTTPServer((host, port), ChartHandler)
+    print(f"🎨 Chart server running at http://{host}:{port}")
     print(f"   Example: http://localhost:{port}/api/chart-image?ticker=AAPL&interval=1d&from=2026-01-01&entry=250")
     print(f"\n   Run this alongside 'npm run dev' for local chart testing")
     try:
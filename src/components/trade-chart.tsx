@@ -61,9 +61,10 @@ export function TradeChart({
       params.set('exit', exitPrice.toString());
     }
 
-    // Local Python server for development, Vercel function for production
+    // Local Python server for development; in production use the persistent
+    // chart worker if one is configured, otherwise the Vercel function
     const isDev = typeof window !== 'undefined' && window.location.hostname === 'localhost';
-    const baseUrl = isDev ? 'http://localhost:3002' : '';
+    const baseUrl = isDev ? 'http://localhost:3002' : (process.env.NEXT_PUBLIC_CHART_SERVER_URL ?? '');
 
     // Add timestamp to prevent caching during development
     if (isDev) {